@@ -6,29 +6,136 @@
 """
 
 import argparse
+import asyncio
 import csv
+import hashlib
+import json
 import os
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from query import query_biomarker
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import Iterator
+from query import (
+    create_async_openai_client,
+    ensure_dir,
+    query_biomarker,
+    query_biomarker_async,
+    sanitize_category,
+    sanitize_name,
+)
+
+
+# 已完成条目的清单，位于输出目录下，记录 行号 -> {filepath, size, sha_of_inputs}
+MANIFEST_NAME = ".manifest.json"
 
 
 def is_file_exists_and_not_empty(filepath: str) -> bool:
     """检查文件是否存在且不为空"""
-    return os.path.exists(filepath) and os.path.getsize(filepath) > 0
+    try:
+        return os.stat(filepath).st_size > 0
+    except FileNotFoundError:
+        return False
+
+
+def scan_dir_entries(directory: str) -> dict:
+    """读取目录一次，返回 {文件名: DirEntry}；目录不存在时返回空字典"""
+    try:
+        with os.scandir(directory) as it:
+            return {entry.name: entry for entry in it if entry.is_file()}
+    except FileNotFoundError:
+        return {}
+
+
+def entry_size(entries: dict, filename: str) -> int:
+    """按需取文件大小，只对实际查到的条目调用 stat；不存在时返回 0"""
+    entry = entries.get(filename)
+    if entry is None:
+        return 0
+    try:
+        return entry.stat().st_size
+    except FileNotFoundError:
+        return 0
 
 
-def build_filename(index: int, name_en: str, name_cn: str, category: str, output_dir: str) -> str:
+def build_filename(index: int, safe_name_en: str, safe_name_cn: str, safe_category: str, output_dir: str) -> str:
     """构建文件名路径，用于检查文件是否存在"""
-    # 与 query.py 中的 buildFilename 逻辑保持一致
-    # 只替换 / 和 \，保留 | 作为分隔符
-    safe_name_en = name_en.replace("/", "-").replace("\\", "-")
-    safe_name_cn = name_cn.replace("/", "-").replace("\\", "-")
-    safe_category = category.replace("/", "-").replace("\\", "-").strip()
+    # 与 query.py 中的文件名逻辑保持一致，传入的名称需已经过 sanitize_name / sanitize_category
     filename = f"{index:03d}|{safe_name_en}|{safe_name_cn}.md"
     return os.path.join(output_dir, safe_category, filename)
 
 
+def inputs_digest(marker: dict) -> str:
+    """生成文档所依赖的输入（分类、英文名、中文名）的摘要，输入变化时清单条目失效"""
+    key = "\0".join((marker["category"], marker["name_en"], marker["name_cn"]))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def load_manifest(path: str) -> dict:
+    """读取完成清单；文件不存在或损坏时返回空字典（回退到扫描文件系统）"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def save_manifest(path: str, manifest: dict) -> None:
+    """先写临时文件再替换，避免中断时留下半个清单"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def iter_markers(csv_path: str, start: int = 1) -> Iterator[dict]:
+    """逐行读取 CSV，从第 start 行开始依次产出生物标志物"""
+    with open(csv_path, "r", encoding="utf-8", buffering=1 << 20) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        # 表头只解析一次，之后按列下标取值；缺少的列取空字符串
+        columns = [header.index(c) if c in header else None
+                   for c in ("category", "Biomarkers_en", "Biomarkers_cn")]
+        
+        # 断点续传时直接按行跳过 start 之前的数据，不做 CSV 字段解析
+        # （假设字段内不含换行）。与 csv.reader 一致，只有真正的空行不计入行号，
+        # 只含空白字符的行仍算作一行
+        skipped = 0
+        while skipped < start - 1:
+            line = next(f, None)
+            if line is None:
+                return
+            if line not in ("\n", "\r\n"):
+                skipped += 1
+        
+        for idx, row in enumerate((row for row in reader if row), start=skipped + 1):
+            category, name_en, name_cn = (
+                row[i] if i is not None and i < len(row) else "" for i in columns
+            )
+            yield {
+                "index": idx,
+                "category": category,
+                "name_en": name_en,
+                "name_cn": name_cn,
+                "safe_category": sanitize_category(category),
+                "safe_name_en": sanitize_name(name_en),
+                "safe_name_cn": sanitize_name(name_cn),
+            }
+
+
+def _result(marker: dict, success: bool, filepath: str = None, content_length: int = 0,
+            error: str = None) -> dict:
+    """构建单个标志物的处理结果"""
+    return {
+        "success": success,
+        "index": marker["index"],
+        "name_en": marker["name_en"],
+        "name_cn": marker["name_cn"],
+        "filepath": filepath,
+        "content_length": content_length,
+        "error": error,
+    }
+
+
 def process_marker(marker: dict, output_dir: str) -> dict:
     """
     处理单个生物标志物
@@ -36,38 +143,61 @@ def process_marker(marker: dict, output_dir: str) -> dict:
     Returns:
         dict: 包含处理结果的字典
     """
-    index = marker["index"]
-    name_en = marker["name_en"]
-    name_cn = marker["name_cn"]
-    category = marker["category"]
-    
     try:
         filepath, content_length = query_biomarker(
-            index=index,
-            name_en=name_en,
-            name_cn=name_cn,
-            category=category,
+            index=marker["index"],
+            name_en=marker["name_en"],
+            name_cn=marker["name_cn"],
+            category=marker["category"],
+            output_dir=output_dir,
+            safe_name_en=marker["safe_name_en"],
+            safe_name_cn=marker["safe_name_cn"],
+            safe_category=marker["safe_category"],
+            stream_to_stdout=False,
+        )
+        return _result(marker, True, filepath=filepath, content_length=content_length)
+    except Exception as e:
+        return _result(marker, False, error=str(e))
+
+
+async def process_marker_async(marker: dict, output_dir: str, client) -> dict:
+    """
+    process_marker 的异步版本
+    
+    Returns:
+        dict: 包含处理结果的字典
+    """
+    try:
+        filepath, content_length = await query_biomarker_async(
+            index=marker["index"],
+            name_en=marker["name_en"],
+            name_cn=marker["name_cn"],
+            category=marker["category"],
             output_dir=output_dir,
+            safe_name_en=marker["safe_name_en"],
+            safe_name_cn=marker["safe_name_cn"],
+            safe_category=marker["safe_category"],
+            client=client,
         )
-        return {
-            "success": True,
-            "index": index,
-            "name_en": name_en,
-            "name_cn": name_cn,
-            "filepath": filepath,
-            "content_length": content_length,
-            "error": None,
-        }
+        return _result(marker, True, filepath=filepath, content_length=content_length)
     except Exception as e:
-        return {
-            "success": False,
-            "index": index,
-            "name_en": name_en,
-            "name_cn": name_cn,
-            "filepath": None,
-            "content_length": 0,
-            "error": str(e),
-        }
+        return _result(marker, False, error=str(e))
+
+
+async def run_async(pending: Iterator[dict], output_dir: str, concurrency: int, on_result) -> None:
+    """用 asyncio 并发处理所有待处理的标志物，单线程即可同时维持大量流式请求"""
+    client = create_async_openai_client()
+    
+    # 固定 concurrency 个 worker 轮流从生成器取下一个标志物，
+    # 生成器按需读取 CSV，任何时刻最多只有 concurrency 个进行中的请求
+    async def worker():
+        for marker in pending:
+            on_result(await process_marker_async(marker, output_dir, client))
+    
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        await client.close()
 
 
 def main():
@@ -102,7 +232,13 @@ def main():
         "--workers",
         type=int,
         default=4,
-        help="并行工作线程数（默认: 4）",
+        help="并行工作线程数，使用 --async 时为并发请求数（默认: 4）",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="使用 asyncio + AsyncOpenAI 在单线程内并发请求，适合调大 --workers",
     )
     
     args = parser.parse_args()
@@ -110,76 +246,125 @@ def main():
     # 确保输出目录存在
     os.makedirs(args.output_dir, exist_ok=True)
     
-    # 读取 CSV
-    markers = []
-    with open(args.csv, "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for idx, row in enumerate(reader, start=1):
-            if idx < args.start:
-                continue
-            markers.append({
-                "index": idx,
-                "category": row.get("category", ""),
-                "name_en": row.get("Biomarkers_en", ""),
-                "name_cn": row.get("Biomarkers_cn", ""),
-            })
+    # 读取完成清单，命中的条目无需访问文件系统
+    manifest_path = os.path.join(args.output_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    manifest_dirty = False
+    # 已提交条目的输入摘要，完成后写入清单
+    pending_digests = {}
     
-    print(f"总共读取到 {len(markers)} 个生物标志物（从第 {args.start} 行开始）")
+    # 流式读取 CSV，边读边分类，需要处理的直接提交
+    # 线程池模式下最多保留 workers*2 个未完成的任务，内存占用保持在 O(workers)
+    total_count = 0
+    skipped_count = 0
+    submitted = 0
+    success_count = 0
+    fail_count = 0
+    completed = 0
+    # 每个分类目录只 scandir 一次，跳过检查改为字典查找
+    dir_entries = {}
+    max_in_flight = args.workers * 2
     
-    # 统计需要处理的和已跳过的
-    to_process = []
-    skipped = []
+    def record(index, filepath, digest, size):
+        nonlocal manifest_dirty
+        manifest[str(index)] = {"filepath": filepath, "size": size, "sha_of_inputs": digest}
+        manifest_dirty = True
     
-    for marker in markers:
-        filepath = build_filename(
-            marker["index"], marker["name_en"], marker["name_cn"], marker["category"], args.output_dir
-        )
-        if is_file_exists_and_not_empty(filepath):
-            skipped.append(marker)
+    # report / iter_pending 都只在主线程（或事件循环）中调用，计数和清单无需加锁
+    def report(result):
+        nonlocal success_count, fail_count, completed
+        completed += 1
+        digest = pending_digests.pop(result["index"], None)
+        if result["success"] and digest is not None:
+            # 与文件扫描一致，只有非空文件才算完成，空输出下次仍会重新生成
+            try:
+                size = os.stat(result["filepath"]).st_size
+            except FileNotFoundError:
+                size = 0
+            if size > 0:
+                record(result["index"], result["filepath"], digest, size)
+        if result["success"]:
+            success_count += 1
+            print(f"[{completed}/{submitted}] ✓ {result['name_en']} ({result['name_cn']}) - {result['content_length']} chars")
         else:
-            to_process.append(marker)
+            fail_count += 1
+            print(f"[{completed}/{submitted}] ✗ {result['name_en']} ({result['name_cn']}) - 失败: {result['error']}")
     
-    print(f"已存在且非空，将跳过: {len(skipped)} 个")
-    print(f"需要处理: {len(to_process)} 个")
+    def iter_pending():
+        nonlocal total_count, skipped_count, submitted
+        for marker in iter_markers(args.csv, args.start):
+            total_count += 1
+            filepath = build_filename(
+                marker["index"],
+                marker["safe_name_en"],
+                marker["safe_name_cn"],
+                marker["safe_category"],
+                args.output_dir,
+            )
+            digest = inputs_digest(marker)
+            entry = manifest.get(str(marker["index"]))
+            if (entry and entry.get("filepath") == filepath and entry.get("sha_of_inputs") == digest
+                    and entry.get("size", 0) > 0):
+                skipped_count += 1
+                continue
+            
+            # 清单未命中时回退到目录扫描
+            category_dir, filename = os.path.split(filepath)
+            if category_dir not in dir_entries:
+                dir_entries[category_dir] = scan_dir_entries(category_dir)
+            size = entry_size(dir_entries[category_dir], filename)
+            if size > 0:
+                skipped_count += 1
+                record(marker["index"], filepath, digest, size)
+                continue
+            if args.limit is not None and submitted >= args.limit:
+                continue
+            
+            # 提交前创建分类目录，每个分类只创建一次
+            ensure_dir(category_dir)
+            submitted += 1
+            pending_digests[marker["index"]] = digest
+            yield marker
     
-    # 应用 limit
+    if args.use_async:
+        print(f"使用 asyncio 并发处理，最多 {args.workers} 个并发请求（从第 {args.start} 行开始）...")
+    else:
+        print(f"使用 {args.workers} 个线程并行处理（从第 {args.start} 行开始）...")
     if args.limit is not None:
-        to_process = to_process[:args.limit]
-        print(f"根据 --limit={args.limit}，实际将处理: {len(to_process)} 个")
-    
-    # 并行处理
-    success_count = 0
-    fail_count = 0
-    completed = 0
-    total = len(to_process)
-    
-    print(f"\n使用 {args.workers} 个线程并行处理...")
+        print(f"根据 --limit={args.limit}，最多处理 {args.limit} 个")
     print("=" * 50)
     
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
-        # 提交所有任务
-        future_to_marker = {
-            executor.submit(process_marker, marker, args.output_dir): marker
-            for marker in to_process
-        }
-        
-        # 处理完成的任务
-        for future in as_completed(future_to_marker):
-            result = future.result()
-            completed += 1
-            
-            if result["success"]:
-                success_count += 1
-                print(f"[{completed}/{total}] ✓ {result['name_en']} ({result['name_cn']}) - {result['content_length']} chars")
-            else:
-                fail_count += 1
-                print(f"[{completed}/{total}] ✗ {result['name_en']} ({result['name_cn']}) - 失败: {result['error']}")
+    try:
+        if args.use_async:
+            asyncio.run(run_async(iter_pending(), args.output_dir, args.workers, report))
+        else:
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                # 滑动窗口：窗口满时等待任意一个完成再提交下一个，未提交的标志物不会进入队列
+                in_flight = set()
+                try:
+                    for marker in iter_pending():
+                        if len(in_flight) >= max_in_flight:
+                            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                report(future.result())
+                        in_flight.add(executor.submit(process_marker, marker, args.output_dir))
+                    for future in as_completed(in_flight):
+                        report(future.result())
+                except KeyboardInterrupt:
+                    # 取消尚未开始的任务，只等待正在进行的请求结束
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+    finally:
+        # 结束（包括中断）时一次性写回清单
+        if manifest_dirty:
+            save_manifest(manifest_path, manifest)
     
     print(f"\n{'='*50}")
     print(f"处理完成!")
     print(f"成功: {success_count} 个")
     print(f"失败: {fail_count} 个")
-    print(f"跳过（已存在）: {len(skipped)} 个")
+    print(f"跳过（已存在）: {skipped_count} 个")
+    print(f"共读取: {total_count} 个")
 
 
 if __name__ == "__main__":
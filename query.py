@@ -1,23 +1,197 @@
+import asyncio
 import os
-from openai import OpenAI
+import random
+import threading
+import time
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
 from dotenv import load_dotenv
 
 # 加载 .env 文件
 load_dotenv()
 
+# 限流、连接/超时错误、服务端 5xx 视为暂时性错误，在当前线程内退避重试
+_RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+_MAX_ATTEMPTS = 5
+_MAX_BACKOFF = 30
 
-def create_openai_client() -> OpenAI:
-    """创建 OpenAI 客户端"""
+# 文件名中的非法字符替换表：名称中 / \ | 都替换为 -（| 用作文件名分隔符），分类名只替换 / 和 \
+_NAME_TABLE = str.maketrans({"/": "-", "\\": "-", "|": "-"})
+_CATEGORY_TABLE = str.maketrans({"/": "-", "\\": "-"})
+
+_SYSTEM_PROMPT = "你是 Kimi，由 Moonshot AI 提供的人工智能助手，你更擅长中文和英文的对话。你会为用户提供安全，有帮助，准确的回答。同时，你会拒绝一切涉及恐怖主义，种族歧视，黄色暴力等问题的回答。Moonshot AI 为专有名词，不可翻译成其他语言。"
+_USER_PROMPT_TEMPLATE = "介绍一下 '{name_en}'（{name_cn}）这个体检指标的涵义，以及常见的异常，异常对应的可能原因，异常对应的建议后续处理（如调整生活方式，进一步详细检查等）。"  # 使用 markdown 输出
+
+
+def sanitize_name(name: str) -> str:
+    """清理生物标志物名称，用于文件名"""
+    return name.translate(_NAME_TABLE)
+
+
+def sanitize_category(category: str) -> str:
+    """清理分类名，用于目录名"""
+    return category.translate(_CATEGORY_TABLE).strip()
+
+
+def _get_api_key() -> str:
     api_key = os.getenv("MOONSHOT_API_KEY")
     if not api_key:
         raise ValueError("MOONSHOT_API_KEY not found in .env file")
+    return api_key
+
+
+# 本进程内已确认存在的目录，每个分类目录只需 makedirs 一次
+_ensured_dirs = set()
+
+
+def ensure_dir(directory: str) -> None:
+    """确保目录存在；同一目录只在第一次调用时访问文件系统"""
+    if directory not in _ensured_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _ensured_dirs.add(directory)
+
+
+def create_openai_client() -> OpenAI:
+    """创建 OpenAI 客户端"""
     return OpenAI(
-        api_key=api_key,
+        api_key=_get_api_key(),
+        base_url="https://api.moonshot.cn/v1",
+        max_retries=0,  # 重试由 _collect_stream 统一处理，避免与 SDK 自带重试叠加
+    )
+
+
+def create_async_openai_client() -> AsyncOpenAI:
+    """创建异步 OpenAI 客户端（需在事件循环内使用）"""
+    return AsyncOpenAI(
+        api_key=_get_api_key(),
         base_url="https://api.moonshot.cn/v1",
+        max_retries=0,  # 重试由 _collect_stream 统一处理，避免与 SDK 自带重试叠加
     )
 
 
-def query_biomarker(index: int, name_en: str, name_cn: str, category: str, output_dir: str = "docs/assets") -> str:
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def _get_client() -> OpenAI:
+    """获取共享的 OpenAI 客户端（线程安全，首次调用时创建），复用连接池"""
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = create_openai_client()
+    return _CLIENT
+
+
+def _prepare_filepath(
+    index: int,
+    name_en: str,
+    name_cn: str,
+    category: str,
+    output_dir: str,
+    safe_name_en: str = None,
+    safe_name_cn: str = None,
+    safe_category: str = None,
+) -> str:
+    """构建输出文件路径，并确保分类目录存在"""
+    # 构建文件名：003|英文名|中文名.md
+    # 清理文件名中的非法字符（调用方已预先清理时直接复用）
+    if safe_name_en is None:
+        safe_name_en = sanitize_name(name_en)
+    if safe_name_cn is None:
+        safe_name_cn = sanitize_name(name_cn)
+    filename = f"{index:03d}|{safe_name_en}|{safe_name_cn}.md"
+    
+    # 构建路径：assets/$(分类名)/$(文件名)
+    # 清理分类名中的非法字符
+    if safe_category is None:
+        safe_category = sanitize_category(category)
+    category_dir = os.path.join(output_dir, safe_category)
+    ensure_dir(category_dir)
+    return os.path.join(category_dir, filename)
+
+
+def _build_request(name_en: str, name_cn: str) -> dict:
+    """构建 chat.completions.create 的请求参数（流式）"""
+    return dict(
+        model="kimi-k2.5",
+        messages=[
+            {"role": "system", "content": _SYSTEM_PROMPT},
+            # 构建查询文本，同时使用英文名和中文名
+            {"role": "user", "content": _USER_PROMPT_TEMPLATE.format(name_en=name_en, name_cn=name_cn)},
+        ],
+        temperature=1,
+        max_tokens=32000,
+        stream=True,
+    )
+
+
+def _write_markdown(filepath: str, parts: list) -> int:
+    """将收集到的分片一次性编码写入文件，返回内容长度"""
+    content = "".join(parts)
+    with open(filepath, "wb") as f:
+        f.write(content.encode("utf-8"))
+    return len(content)
+
+
+def _backoff_delay(attempt: int) -> float:
+    """第 attempt 次失败后的等待秒数：指数退避 + 随机抖动"""
+    return min(2 ** attempt + random.random(), _MAX_BACKOFF)
+
+
+def _collect_stream(client: OpenAI, request: dict, stream_to_stdout: bool = False) -> list:
+    """发起流式请求并收集所有分片，遇到暂时性错误时重新请求；stream_to_stdout 时同时实时打印"""
+    for attempt in range(_MAX_ATTEMPTS):
+        try:
+            stream = client.chat.completions.create(**request)
+            parts = []
+            for chunk in stream:
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    parts.append(delta.content)
+                    if stream_to_stdout:
+                        print(delta.content, end="", flush=False)
+            return parts
+        except _RETRYABLE_ERRORS:
+            if attempt == _MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(_backoff_delay(attempt))
+
+
+async def _collect_stream_async(client: AsyncOpenAI, request: dict) -> list:
+    """_collect_stream 的异步版本"""
+    for attempt in range(_MAX_ATTEMPTS):
+        try:
+            stream = await client.chat.completions.create(**request)
+            parts = []
+            async for chunk in stream:
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    parts.append(delta.content)
+            return parts
+        except _RETRYABLE_ERRORS:
+            if attempt == _MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(_backoff_delay(attempt))
+
+
+def query_biomarker(
+    index: int,
+    name_en: str,
+    name_cn: str,
+    category: str,
+    output_dir: str = "docs/assets",
+    safe_name_en: str = None,
+    safe_name_cn: str = None,
+    safe_category: str = None,
+    stream_to_stdout: bool = False,
+) -> tuple:
     """
     查询单个生物标志物，生成说明文档并保存为 markdown 文件。
     
@@ -27,54 +201,58 @@ def query_biomarker(index: int, name_en: str, name_cn: str, category: str, outpu
         name_cn: 生物标志物中文名
         category: 分类名（CSV第一列）
         output_dir: 输出目录，默认为 "assets"
+        safe_name_en / safe_name_cn / safe_category: 预先清理过的名称，未提供时在此计算
+        stream_to_stdout: 是否把模型输出实时打印到终端（仅用于单条调试，并行时应关闭）
     
     Returns:
-        生成的文件路径
+        (生成的文件路径, 内容长度)
     """
-    import os
+    client = _get_client()
     
-    client = create_openai_client()
+    filepath = _prepare_filepath(
+        index, name_en, name_cn, category, output_dir, safe_name_en, safe_name_cn, safe_category
+    )
+    # 先收集所有分片，流结束后一次性编码并写入
+    parts = _collect_stream(client, _build_request(name_en, name_cn), stream_to_stdout)
     
-    # 构建查询文本，同时使用英文名和中文名
-    text = f"介绍一下 '{name_en}'（{name_cn}）这个体检指标的涵义，以及常见的异常，异常对应的可能原因，异常对应的建议后续处理（如调整生活方式，进一步详细检查等）。" #使用 markdown 输出"
+    return filepath, _write_markdown(filepath, parts)
+
+
+async def query_biomarker_async(
+    index: int,
+    name_en: str,
+    name_cn: str,
+    category: str,
+    output_dir: str = "docs/assets",
+    safe_name_en: str = None,
+    safe_name_cn: str = None,
+    safe_category: str = None,
+    client: AsyncOpenAI = None,
+) -> tuple:
+    """
+    query_biomarker 的异步版本，供 asyncio 并发调用。
     
-    # 构建文件名：003|英文名|中文名.md
-    # 清理文件名中的非法字符
-    safe_name_en = name_en.replace("/", "-").replace("\\", "-").replace("|", "-")
-    safe_name_cn = name_cn.replace("/", "-").replace("\\", "-").replace("|", "-")
-    filename = f"{index:03d}|{safe_name_en}|{safe_name_cn}.md"
+    Args:
+        client: 共享的 AsyncOpenAI 客户端，未提供时新建一个
+        其余参数同 query_biomarker
     
-    # 构建路径：assets/$(分类名)/$(文件名)
-    # 清理分类名中的非法字符
-    safe_category = category.replace("/", "-").replace("\\", "-").strip()
-    category_dir = os.path.join(output_dir, safe_category)
-    os.makedirs(category_dir, exist_ok=True)
-    filepath = os.path.join(category_dir, filename)
+    Returns:
+        (生成的文件路径, 内容长度)
+    """
+    if client is None:
+        client = create_async_openai_client()
     
-    stream = client.chat.completions.create(
-        model="kimi-k2.5",
-        messages=[
-            {"role": "system", "content": "你是 Kimi，由 Moonshot AI 提供的人工智能助手，你更擅长中文和英文的对话。你会为用户提供安全，有帮助，准确的回答。同时，你会拒绝一切涉及恐怖主义，种族歧视，黄色暴力等问题的回答。Moonshot AI 为专有名词，不可翻译成其他语言。"},
-            {"role": "user", "content": text}
-        ],
-        temperature=1,
-        max_tokens=32000,
-        stream=True,
+    filepath = _prepare_filepath(
+        index, name_en, name_cn, category, output_dir, safe_name_en, safe_name_cn, safe_category
     )
+    parts = await _collect_stream_async(client, _build_request(name_en, name_cn))
     
-    content = ""
-    for chunk in stream:
-        delta = chunk.choices[0].delta
-        if delta.content:
-            content += delta.content
-    
-    with open(filepath, "w") as f:
-        f.write(content)
-    
-    return filepath, len(content)
+    return filepath, _write_markdown(filepath, parts)
 
 
 if __name__ == "__main__":
     # 保持向后兼容，可以直接运行
     name = "尿白蛋白/肌酐比值"
-    query_biomarker(index=1, name_en=name, name_cn=name, category="Kidney Health", output_dir="assets")
+    query_biomarker(
+        index=1, name_en=name, name_cn=name, category="Kidney Health", output_dir="assets", stream_to_stdout=True
+    )